@@ -1,140 +1,685 @@
+import ast
 import asyncio
+import atexit
+import hashlib
+import json
+import math
+import operator
 import os
+import re
+import sys
+import threading
+from collections import OrderedDict
 
 import streamlit as st
+from diskcache import Cache
 from dotenv import load_dotenv
 
 # LangChain + MCP imports
+from langchain_core.messages import HumanMessage, ToolMessage
 from langchain_mcp_adapters.client import MultiServerMCPClient
+from langchain_mcp_adapters.tools import load_mcp_tools
 from langchain_openai import ChatOpenAI
 
-# LangGraph imports
-from langgraph.graph import StateGraph, MessagesState, START, END
-from langgraph.prebuilt import ToolNode
-
 
 # ----------------------------
 # LOAD ENVIRONMENT VARIABLES
 # ----------------------------
 load_dotenv()
 
+# Load OpenAI API key (read once at import)
+OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+
+# Full absolute path to the MCP server (launched over stdio)
+MCP_SERVER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "mcp_server.py")
+
+# Chat model used by the pipeline (also part of the cache key)
+MODEL_NAME = "gpt-4o-mini"
+
+# On-disk exact-match response cache (survives app restarts)
+RESPONSE_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".mcp_cache")
+
+# Seconds a cached answer stays valid
+RESPONSE_CACHE_TTL = 3600
+
+# Max number of answers kept in the normalized-prompt cache
+NORMALIZED_CACHE_SIZE = 256
+
+# Max queries run_mcp_batch keeps in flight (provider rate limits)
+BATCH_CONCURRENCY = 8
+
+# Max LLM ↔ tool round trips per query before giving up
+MAX_TOOL_ROUNDS = 12
+
+# Yielded by stream_mcp_query when the text streamed so far was
+# preamble to tool calls, not the answer: discard it
+STREAM_RESET = object()
+
 
 # ----------------------------
-# ASYNC FUNCTION TO RUN MCP QUERY
+# SHARED PIPELINE (BUILT ONCE)
 # ----------------------------
-async def run_mcp_query(user_input: str) -> str:
+@st.cache_resource
+def _runtime() -> dict:
     """
-    Takes user input, sends it to the LLM,
-    lets the LLM decide whether to call MCP tools,
-    and returns the final answer.
+    Process-wide holder for the objects reused across queries.
+    Streamlit re-executes this script on every interaction,
+    so plain module globals would be rebuilt each time.
+    """
+    return {
+        "lock": asyncio.Lock(),
+        "client": None,
+        "session": None,
+        "session_closer": None,
+        "exit_hook": False,
+        "pipeline": None,
+        "normalized": OrderedDict(),
+    }
+
+
+@st.cache_resource
+def _get_model() -> ChatOpenAI:
+    """
+    Creates the chat model once per process.
+    (You can swap this with any supported LLM)
     """
+    return ChatOpenAI(
+        model=MODEL_NAME,
+        api_key=OPENAI_API_KEY
+    )
 
-    # Load OpenAI API key
-    openai_key = os.getenv("OPENAI_API_KEY")
 
-    # Initialize chat model
-    # (You can swap this with any supported LLM)
-    model = ChatOpenAI(
-        model="gpt-4o-mini",
-        api_key=openai_key
-    )
+@st.cache_resource
+def _response_cache() -> Cache:
+    """
+    Opens the on-disk response cache once per process.
+    """
+    return Cache(RESPONSE_CACHE_DIR)
 
-    # ----------------------------
-    # MCP CLIENT CONFIGURATION
-    # ----------------------------
-    client = MultiServerMCPClient(
-        {
-            "math": {
-                "transport": "streamable_http",
-                "url": "http://127.0.0.1:8000/mcp"
+
+@st.cache_resource
+def _event_loop() -> asyncio.AbstractEventLoop:
+    """
+    Starts one event loop in a daemon thread for the whole process.
+    Every query is scheduled on it, so the MCP session and the
+    HTTP connection pools stay alive between button presses.
+    """
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return loop
+
+
+def _is_shared_loop() -> bool:
+    """
+    True when running on the shared background loop.
+    """
+    return asyncio.get_running_loop() is _event_loop()
+
+
+async def _on_shared_loop(coro):
+    """
+    Runs coro on the shared background loop and awaits the result.
+    The pipeline lock and the MCP session belong to that loop, so
+    callers on another loop (e.g. asyncio.run in a script) must
+    not touch them directly: the lock would be bound to the wrong
+    loop, and closing their loop would cancel the MCP session.
+    """
+    future = asyncio.run_coroutine_threadsafe(coro, _event_loop())
+    return await asyncio.wrap_future(future)
+
+
+async def ensure_client() -> MultiServerMCPClient:
+    """
+    Returns the single MCP client shared by every query,
+    creating it on first use.
+    """
+    runtime = _runtime()
+
+    if runtime["client"] is None:
+        # ----------------------------
+        # MCP CLIENT CONFIGURATION
+        # ----------------------------
+        # The server runs on this machine, so start it as a child
+        # process and talk over stdio pipes (no TCP / HTTP per call)
+        runtime["client"] = MultiServerMCPClient(
+            {
+                "math": {
+                    "transport": "stdio",
+                    "command": sys.executable,
+                    "args": [MCP_SERVER_PATH, "--stdio"],
+                }
             }
-        }
-    )
+        )
 
 
-    # use this if we have used stdio transport in server
-    # client = MultiServerMCPClient(  
-        # {
-            # "math": {
-                # "command": "python",
-                # # Full absolute path to math_server.py
-                # "args": ["E:/langraph_custom_mcp_demo/custom_mcp_server.py"],
-                # "transport": "stdio",
+        # use this if the server runs separately over HTTP
+        # (python mcp_server.py)
+        # runtime["client"] = MultiServerMCPClient(
+            # {
+                # "math": {
+                    # "transport": "streamable_http",
+                    # "url": "http://127.0.0.1:8000/mcp"
+                # }
             # }
-        # }
-    # )
-    
+        # )
+
+    return runtime["client"]
+
+
+async def _ensure_session():
+    """
+    Opens one MCP session on first use and keeps it open
+    in a background task, so tool calls reuse its connection
+    instead of reconnecting for every call.
+    """
+    runtime = _runtime()
+
+    if runtime["session"] is None:
+        client = await ensure_client()
+        loop = asyncio.get_running_loop()
+        ready = loop.create_future()
+        stop = asyncio.Event()
+
+        async def hold_session():
+            try:
+                async with client.session("math") as session:
+                    ready.set_result(session)
+                    await stop.wait()
+            except Exception as exc:
+                if not ready.done():
+                    ready.set_exception(exc)
+            finally:
+                # Wake the waiter even if cancelled before the session opened
+                if not ready.done():
+                    ready.cancel()
+                # Force a rebuild on the next query if the session dropped
+                runtime["session"] = None
+                runtime["pipeline"] = None
+
+        task = loop.create_task(hold_session())
+        runtime["session_closer"] = (loop, stop, task)
+
+        # One exit handler per process; it closes whichever session is current
+        if not runtime["exit_hook"]:
+            atexit.register(_close_session)
+            runtime["exit_hook"] = True
+
+        runtime["session"] = await ready
+
+    return runtime["session"]
+
+
+def _close_session():
+    """
+    Signals the current session task to exit and waits for it.
+    """
+    closer = _runtime()["session_closer"]
+    if closer is None:
+        return
+    loop, stop, task = closer
+
+    async def close():
+        stop.set()
+        await task
+
+    if loop.is_running() and not task.done():
+        asyncio.run_coroutine_threadsafe(close(), loop).result(timeout=5)
+
+
+async def _get_pipeline():
+    """
+    Builds the LLM, MCP client and tools on first use
+    and returns the cached objects afterwards.
+    """
+    runtime = _runtime()
+
+    async with runtime["lock"]:
+        if runtime["pipeline"] is None:
+            runtime["pipeline"] = await _build_pipeline()
+
+    # pipeline = (client, tools, model_with_tools, tools_by_name)
+    return runtime["pipeline"]
+
+
+async def _build_pipeline():
+    """
+    Creates every object the query pipeline needs.
+    Only called once per process by _get_pipeline().
+    """
+
+    # Shared chat model
+    model = _get_model()
+
+    # Reuse the process-wide MCP client and its open session
+    client = await ensure_client()
+    session = await _ensure_session()
 
     # Fetch all tools exposed by the MCP server
-    tools = await client.get_tools()
+    # (bound to the open session, so calls skip the reconnect)
+    tools = await load_mcp_tools(session)
 
     # Bind tools to the LLM
     model_with_tools = model.bind_tools(tools)
 
-    # ToolNode executes MCP tools when the model requests them
-    tool_node = ToolNode(tools)
+    # Lookup table used to execute the tools the model asks for
+    tools_by_name = {tool.name: tool for tool in tools}
 
+    return client, tools, model_with_tools, tools_by_name
 
-    # ----------------------------
-    # CONTROL FLOW DECISION
-    # ----------------------------
-    def should_continue(state: MessagesState):
-        """
-        Decide whether to call tools or finish execution.
-        """
-        messages = state["messages"]
-        last_message = messages[-1]
 
-        # If model asked for tool calls → go to tools node
-        if last_message.tool_calls:
-            return "tools"
+# ----------------------------
+# TOOL-CALL LOOP
+# ----------------------------
+# The agent is a two-state machine:
+#   call model → (tool calls? → run tools → call model | done)
+# so it is written as a plain loop instead of a LangGraph graph.
+
+async def _invoke_tool(tools_by_name: dict, tool_call: dict) -> ToolMessage:
+    """
+    Runs one tool call on the MCP server.
+    Errors are returned to the LLM as an error ToolMessage
+    (like LangGraph's ToolNode) instead of failing the query.
+    """
+    tool = tools_by_name.get(tool_call["name"])
+
+    try:
+        if tool is None:
+            raise ValueError(f"Unknown tool: {tool_call['name']}")
+        return await tool.ainvoke(tool_call)
+    except Exception as e:
+        return ToolMessage(
+            content=f"Error: {e!r}\n Please fix your mistakes.",
+            name=tool_call["name"],
+            tool_call_id=tool_call["id"],
+            status="error",
+        )
+
+
+async def _call_tools(tools_by_name: dict, messages: list):
+    """
+    Runs all tool calls of the last model message concurrently
+    and appends the tool results to the conversation.
+    """
+    tool_calls = messages[-1].tool_calls
+    results = await asyncio.gather(
+        *(_invoke_tool(tools_by_name, call) for call in tool_calls)
+    )
+    messages.extend(results)
 
-        # Otherwise → end graph
-        return END
 
+async def _run_agent(user_input: str) -> str:
+    """
+    Calls the LLM, runs any tools it asks for,
+    and repeats until it replies without tool calls.
+    """
+    _, _, model_with_tools, tools_by_name = await _get_pipeline()
+    messages = [HumanMessage(content=user_input)]
 
-    # ----------------------------
-    # MODEL CALL NODE
-    # ----------------------------
-    async def call_model(state: MessagesState):
-        """
-        Sends conversation to the LLM.
-        """
-        messages = state["messages"]
+    for _ in range(MAX_TOOL_ROUNDS):
         response = await model_with_tools.ainvoke(messages)
-        return {"messages": [response]}
+        messages.append(response)
+
+        # No tool calls → this is the final answer
+        if not response.tool_calls:
+            content = response.content
+            return content if isinstance(content, str) else str(content)
+
+        await _call_tools(tools_by_name, messages)
+
+    raise RuntimeError(f"No final answer after {MAX_TOOL_ROUNDS} tool rounds.")
+
+
+async def _stream_agent(user_input: str):
+    """
+    Same loop as _run_agent, but streams the LLM output
+    and yields the text tokens as they arrive.
+    Yields STREAM_RESET after a round whose text turned out
+    to precede tool calls, so only the final round's text
+    makes up the answer.
+    """
+    _, _, model_with_tools, tools_by_name = await _get_pipeline()
+    messages = [HumanMessage(content=user_input)]
+
+    for _ in range(MAX_TOOL_ROUNDS):
+        # Merge the chunks back into one message (incl. tool calls)
+        response = None
+        streamed_text = False
+        async for chunk in model_with_tools.astream(messages):
+            response = chunk if response is None else response + chunk
+            if isinstance(chunk.content, str) and chunk.content:
+                streamed_text = True
+                yield chunk.content
+        messages.append(response)
+
+        # No tool calls → the streamed text was the final answer
+        if not response.tool_calls:
+            return
+
+        if streamed_text:
+            yield STREAM_RESET
+
+        await _call_tools(tools_by_name, messages)
+
+    raise RuntimeError(f"No final answer after {MAX_TOOL_ROUNDS} tool rounds.")
+
+
+# ----------------------------
+# LOCAL FAST PATH (NO LLM)
+# ----------------------------
+_BINARY_OPS = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.Div: operator.truediv,
+}
+
+_FUNCTIONS = {
+    "sqrt": math.sqrt,
+    "factorial": math.factorial,
+}
 
+# Keeps the fast path from computing huge factorials inline
+_MAX_FAST_FACTORIAL = 1000
 
-    # ----------------------------
-    # LANGGRAPH PIPELINE
-    # ----------------------------
-    builder = StateGraph(MessagesState)
+# Longer inputs go to the LLM (also bounds AST depth / number size)
+_MAX_FAST_INPUT_LENGTH = 200
 
-    # Register nodes
-    builder.add_node("call_model", call_model)
-    builder.add_node("tools", tool_node)
+# Leading words stripped before trying to parse the question
+_QUESTION_PREFIX = re.compile(
+    r"^\s*(what\s+is|what's|calculate|compute)\s+", re.IGNORECASE
+)
 
-    # Define execution flow
-    builder.add_edge(START, "call_model")
-    builder.add_conditional_edges("call_model", should_continue)
-    builder.add_edge("tools", "call_model")
 
-    # Compile the graph
-    graph = builder.compile()
+def _evaluate(node):
+    """
+    Evaluates a whitelisted arithmetic AST node.
+    Raises ValueError for anything outside the whitelist.
+    """
+    if isinstance(node, ast.Constant) and type(node.value) in (int, float):
+        return node.value
+
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.UAdd, ast.USub)):
+        value = _evaluate(node.operand)
+        return -value if isinstance(node.op, ast.USub) else value
+
+    if isinstance(node, ast.BinOp) and type(node.op) in _BINARY_OPS:
+        left = _evaluate(node.left)
+        right = _evaluate(node.right)
+        return _BINARY_OPS[type(node.op)](left, right)
+
+    if (
+        isinstance(node, ast.Call)
+        and isinstance(node.func, ast.Name)
+        and node.func.id in _FUNCTIONS
+        and len(node.args) == 1
+        and not node.keywords
+    ):
+        arg = _evaluate(node.args[0])
+        if node.func.id == "factorial" and arg > _MAX_FAST_FACTORIAL:
+            raise ValueError("factorial argument too large for the fast path")
+        return _FUNCTIONS[node.func.id](arg)
+
+    raise ValueError("unsupported expression")
+
+
+def _try_fast_path(user_input: str):
+    """
+    Answers plain arithmetic like "what is 12*47?" locally.
+    Returns None when the input is not a simple expression,
+    so the caller falls back to the LLM.
+    """
+    expression = _QUESTION_PREFIX.sub("", user_input).strip().rstrip("?").strip()
+    if len(expression) > _MAX_FAST_INPUT_LENGTH:
+        return None
+
+    try:
+        tree = ast.parse(expression, mode="eval")
+        result = _evaluate(tree.body)
+        # inf / nan (e.g. "1e308*10") is not an answer
+        if isinstance(result, float) and not math.isfinite(result):
+            return None
+        # str() of a huge int raises ValueError (int digit limit)
+        return f"{expression} = {result}"
+    except (
+        SyntaxError,
+        ValueError,
+        TypeError,
+        ZeroDivisionError,
+        OverflowError,
+        RecursionError,
+    ):
+        # Not plain arithmetic (or undefined / too large):
+        # let the LLM and the MCP tools handle it
+        return None
+
 
-    # Run the graph
-    result = await graph.ainvoke(
-        {"messages": [{"role": "user", "content": user_input}]}
+# ----------------------------
+# EXACT RESPONSE CACHE
+# ----------------------------
+def _cache_key(user_input: str, tool_names: list[str]) -> str:
+    """
+    Hashes the model name, the normalized prompt and the
+    available tool names, so answers are not reused after
+    the model or the server's tools change.
+    """
+    payload = json.dumps(
+        {
+            "model": MODEL_NAME,
+            "prompt": user_input.strip().lower(),
+            "tools": sorted(tool_names),
+        },
+        sort_keys=True,
     )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def _cache_get(key: str):
+    """
+    Returns the cached answer, or None if missing or expired.
+    """
+    return _response_cache().get(key)
+
+
+def _cache_put(key: str, answer: str):
+    """
+    Stores an answer for RESPONSE_CACHE_TTL seconds.
+    """
+    _response_cache().set(key, answer, expire=RESPONSE_CACHE_TTL)
+
+
+# ----------------------------
+# NORMALIZED PROMPT CACHE
+# ----------------------------
+# Catches rewordings that only differ in case, spacing,
+# punctuation or filler words
+# ("What is the square root of 81?" / "square root of 81").
+# Meaning-level matches ("five plus five") are out of scope:
+# for a calculator, prompts that differ by one token usually
+# have different answers.
+# Prompt tokens in order: numbers (incl. decimals like ".5"),
+# words, and operator symbols (a sign is its own token)
+_TOKEN = re.compile(r"\d+(?:\.\d+)?|\.\d+|[a-z]+|[^\sa-z0-9.,?!']")
+
+# Filler words ignored when comparing two prompts
+_FILLER = frozenset(
+    {"what", "whats", "s", "is", "the", "of", "please", "calculate", "compute", "a", "an"}
+)
+
+
+def _signature(user_input: str) -> tuple:
+    """
+    Returns the prompt's tokens in order, minus filler words.
+    Prompts only share an answer when their signatures are
+    equal, so operand order and operator placement count.
+    """
+    tokens = _TOKEN.findall(user_input.strip().lower())
+    return tuple(t for t in tokens if t not in _FILLER)
+
+
+def _normalized_get(user_input: str):
+    """
+    Returns the answer of a previous prompt with the same
+    signature (or None) and marks it recently used.
+    """
+    normalized = _runtime()["normalized"]
+    signature = _signature(user_input)
+    answer = normalized.get(signature)
+    if answer is not None:
+        normalized.move_to_end(signature)
+    return answer
+
+
+def _normalized_put(user_input: str, answer: str):
+    """
+    Stores an answer, evicting the least recently used one when full.
+    """
+    normalized = _runtime()["normalized"]
+    signature = _signature(user_input)
+    normalized[signature] = answer
+    normalized.move_to_end(signature)
+    if len(normalized) > NORMALIZED_CACHE_SIZE:
+        normalized.popitem(last=False)
+
+
+# ----------------------------
+# CACHE LOOKUP / STORE
+# ----------------------------
+async def _lookup(user_input: str):
+    """
+    Tries the fast path and both caches.
+    Returns (answer, key); answer is None on a miss
+    and key is then used to store the new answer.
+    """
+
+    # Plain arithmetic never needs the LLM
+    answer = _try_fast_path(user_input)
+    if answer is not None:
+        return answer, None
+
+    # Same question asked before (even in an earlier run) → reuse the answer
+    _, tools, _, _ = await _get_pipeline()
+    key = _cache_key(user_input, [tool.name for tool in tools])
+    answer = _cache_get(key)
+    if answer is not None:
+        return answer, key
+
+    # Reworded question asked before → reuse that answer
+    # (not copied into the exact cache, which is keyed on the raw prompt)
+    answer = _normalized_get(user_input)
+
+    return answer, key
+
 
-    # Extract final response
-    last_msg = result["messages"][-1].content
-    return last_msg if isinstance(last_msg, str) else str(last_msg)
+def _store(user_input: str, key: str, answer: str):
+    """
+    Saves a fresh LLM answer in both caches.
+    Empty answers are never cached.
+    """
+    if not answer:
+        return
+
+    _cache_put(key, answer)
+    _normalized_put(user_input, answer)
+
+
+# ----------------------------
+# ASYNC FUNCTION TO RUN MCP QUERY
+# ----------------------------
+async def run_mcp_query(user_input: str) -> str:
+    """
+    Takes user input, sends it to the LLM,
+    lets the LLM decide whether to call MCP tools,
+    and returns the final answer.
+    Can be awaited from any event loop (see _on_shared_loop).
+    """
+    if not _is_shared_loop():
+        return await _on_shared_loop(run_mcp_query(user_input))
+
+    answer, key = await _lookup(user_input)
+    if answer is not None:
+        return answer
+
+    answer = await _run_agent(user_input)
+
+    _store(user_input, key, answer)
+    return answer
+
+
+# ----------------------------
+# ASYNC GENERATOR TO STREAM MCP QUERY
+# ----------------------------
+async def stream_mcp_query(user_input: str):
+    """
+    Same as run_mcp_query, but yields the answer text
+    token by token as the LLM produces it.
+    A STREAM_RESET item means: drop the text received so far.
+    """
+    answer, key = await _lookup(user_input)
+    if answer is not None:
+        yield answer
+        return
+
+    pieces = []
+    async for piece in _stream_agent(user_input):
+        if piece is STREAM_RESET:
+            pieces.clear()
+        else:
+            pieces.append(piece)
+        yield piece
+
+    _store(user_input, key, "".join(pieces))
+
+
+# ----------------------------
+# ASYNC FUNCTION TO RUN MANY QUERIES
+# ----------------------------
+async def run_mcp_batch(inputs: list[str]) -> list[str]:
+    """
+    Runs several queries concurrently against the shared pipeline
+    and returns the answers in the same order as the inputs.
+    At most BATCH_CONCURRENCY queries are in flight at once.
+    Can be awaited from any event loop (see _on_shared_loop).
+    """
+    if not _is_shared_loop():
+        return await _on_shared_loop(run_mcp_batch(inputs))
+
+    semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+
+    async def run_one(user_input: str) -> str:
+        async with semaphore:
+            return await run_mcp_query(user_input)
+
+    return await asyncio.gather(*(run_one(q) for q in inputs))
+
+
+def run_mcp_batch_sync(inputs: list[str]) -> list[str]:
+    """
+    Blocking version of run_mcp_batch for synchronous callers
+    (scripts, evaluations).
+    """
+    return asyncio.run_coroutine_threadsafe(
+        run_mcp_batch(inputs), _event_loop()
+    ).result()
 
 
 # ----------------------------
 # STREAMLIT UI
 # ----------------------------
+def _iterate(stream, loop: asyncio.AbstractEventLoop):
+    """
+    Drives an async generator on the background loop
+    and yields its items to synchronous code.
+    """
+    async def next_item():
+        return await stream.__anext__()
+
+    while True:
+        try:
+            yield asyncio.run_coroutine_threadsafe(next_item(), loop).result()
+        except StopAsyncIteration:
+            return
+
+
 def main():
     st.set_page_config(page_title="MCP Math Chat", page_icon="🧮")
     st.title("🧮 MCP Math Chat")
@@ -143,8 +688,13 @@ def main():
 
     if st.button("Send") and user_input.strip():
         with st.spinner("Thinking..."):
-            answer = asyncio.run(run_mcp_query(user_input))
-            st.success(answer)
+            # Render tokens as they arrive instead of waiting for the full answer
+            placeholder = st.empty()
+            text = ""
+            for piece in _iterate(stream_mcp_query(user_input), _event_loop()):
+                # Text that preceded tool calls is replaced by the answer
+                text = "" if piece is STREAM_RESET else text + piece
+                placeholder.markdown(text)
 
 
 # ----------------------------
@@ -1,18 +1,106 @@
 # Import FastMCP to create an MCP tool server
 from mcp.server.fastmcp import FastMCP
+from mcp.server.fastmcp.exceptions import ToolError
+
+# Argument validators compiled once at import
+from pydantic import TypeAdapter, ValidationError
 
 # Standard math library (needed for sqrt, factorial)
 import math
 
+# Reads the --stdio command-line flag
+import sys
+
+# Worker count and app path for the HTTP server
+import os
+
+# NumPy for the vectorized batch tools
+import numpy as np
+
+# ASGI server used to serve the HTTP transport
+import uvicorn
+
+# Detects async tools in the fast dispatch path
+import inspect
+
+# Memoizes the pure math tools
+import functools
+
+
+# ----------------------------
+# FAST TOOL DISPATCH
+# ----------------------------
+class FastMath(FastMCP):
+    """
+    FastMCP with a shortcut for the math tools.
+    Arguments are checked with validators compiled once at
+    import, and the function is invoked directly instead of
+    building and validating a pydantic model per call.
+    Anything else (missing, extra or invalid arguments)
+    takes the normal path, which reports the error.
+    """
+
+    async def call_tool(self, name, arguments):
+        fast = _FAST_TOOLS.get(name)
+        if fast is None or arguments.keys() != fast[1].keys():
+            return await super().call_tool(name, arguments)
+
+        fn, spec = fast
+        try:
+            kwargs = {k: validate(arguments[k]) for k, validate in spec.items()}
+        except ValidationError:
+            return await super().call_tool(name, arguments)
+
+        try:
+            result = fn(**kwargs)
+            if inspect.isawaitable(result):
+                result = await result
+        except Exception as e:
+            # Same error shape as FastMCP's generic path
+            raise ToolError(f"Error executing tool {name}: {e}") from e
+
+        # Private FastMCP API; mcp is pinned in requirements.txt for this
+        tool = self._tool_manager.get_tool(name)
+        return tool.fn_metadata.convert_result(result)
+
+
 # Create an MCP server instance
 # "Math" is the tool namespace that clients will see
-mcp = FastMCP("Math")
+# stateless_http: no per-session state on the server, so any
+# worker process can answer any request (see HTTP_WORKERS)
+mcp = FastMath("Math", stateless_http=True)
+
+# HTTP tuning for many tiny tool responses:
+# keep idle connections open for reuse and queue bursts of connects.
+# Responses are not gzipped: they are a few bytes, and
+# compressing them would cost more CPU than it saves.
+HTTP_KEEP_ALIVE_SECONDS = 30
+HTTP_BACKLOG = 2048
+
+# One worker process per CPU, so a large batch tool call
+# does not hold up tool calls on the other cores
+HTTP_WORKERS = os.cpu_count() or 1
+
+# Largest n accepted by the factorial tool
+# (1500! has 4115 digits; MCP clients reject JSON integers
+# above ~4300 digits, so larger results cannot be delivered)
+MAX_FACTORIAL_N = 1500
+
+# Cache sizes for the memoized tools
+# (factorial results can be a few KB each, so keep fewer)
+TOOL_CACHE_SIZE = 4096
+FACTORIAL_CACHE_SIZE = 256
 
 
 # ----------------------------
 # TOOL 1: ADDITION
 # ----------------------------
+# The pure tools are memoized with lru_cache, so repeated
+# calls with the same arguments skip the computation.
+# divide is left uncached (float keys); calls that raise
+# are never cached.
 @mcp.tool()
+@functools.lru_cache(maxsize=TOOL_CACHE_SIZE)
 def add(a: int, b: int) -> int:
     """
     Add two numbers.
@@ -25,6 +113,7 @@ def add(a: int, b: int) -> int:
 # TOOL 2: MULTIPLICATION
 # ----------------------------
 @mcp.tool()
+@functools.lru_cache(maxsize=TOOL_CACHE_SIZE)
 def multiply(a: int, b: int) -> int:
     """
     Multiply two numbers.
@@ -50,6 +139,7 @@ def divide(a: float, b: float) -> float:
 # TOOL 4: SQUARE ROOT
 # ----------------------------
 @mcp.tool()
+@functools.lru_cache(maxsize=TOOL_CACHE_SIZE)
 def square_root(x: float) -> float:
     """
     Return the square root of x.
@@ -64,27 +154,149 @@ def square_root(x: float) -> float:
 # TOOL 5: FACTORIAL
 # ----------------------------
 @mcp.tool()
+@functools.lru_cache(maxsize=FACTORIAL_CACHE_SIZE)
 def factorial(n: int) -> int:
     """
     Return factorial of n.
-    Raises error for negative numbers.
+    Raises error for negative numbers or n above MAX_FACTORIAL_N.
+    (Up to the cap this takes ~0.1 ms, so it runs inline.)
     """
     if n < 0:
         raise ValueError("Factorial is not defined for negative numbers.")
+    if n > MAX_FACTORIAL_N:
+        raise ValueError(f"Factorial is limited to n <= {MAX_FACTORIAL_N}.")
     return math.factorial(n)
 
 
+# ----------------------------
+# BATCH TOOLS (VECTORIZED)
+# ----------------------------
+# One call computes a whole list, instead of one
+# MCP round-trip per element.
+# JSON has no NaN / infinity (they are sent as null), so
+# every result is checked to be a finite number.
+
+def _as_arrays(a: list[float], b: list[float]):
+    """
+    Converts two lists to float arrays of the same length.
+    """
+    if len(a) != len(b):
+        raise ValueError("Both lists must have the same length.")
+    return _finite(np.asarray(a, dtype=float)), _finite(np.asarray(b, dtype=float))
+
+
+def _finite(values: np.ndarray) -> np.ndarray:
+    """
+    Returns values unchanged.
+    Raises an error if any of them is NaN or infinite.
+    """
+    if not np.isfinite(values).all():
+        raise ValueError("Numbers must be finite (no NaN, infinity or overflow).")
+    return values
+
+
+@mcp.tool()
+def add_batch(a: list[float], b: list[float]) -> list[float]:
+    """
+    Add two lists of numbers element by element.
+    """
+    x, y = _as_arrays(a, b)
+    return _finite(x + y).tolist()
+
+
+@mcp.tool()
+def multiply_batch(a: list[float], b: list[float]) -> list[float]:
+    """
+    Multiply two lists of numbers element by element.
+    """
+    x, y = _as_arrays(a, b)
+    return _finite(x * y).tolist()
+
+
+@mcp.tool()
+def divide_batch(a: list[float], b: list[float]) -> list[float | None]:
+    """
+    Divide a by b element by element.
+    Division by zero gives None (null) for that element.
+    """
+    x, y = _as_arrays(a, b)
+    nonzero = y != 0
+    result = _finite(np.divide(x, y, out=np.zeros_like(x), where=nonzero))
+    return [q if ok else None for q, ok in zip(result.tolist(), nonzero.tolist())]
+
+
+@mcp.tool()
+def sqrt_batch(x: list[float]) -> list[float]:
+    """
+    Return the square root of every number in x.
+    Raises error if any number is negative or not finite.
+    """
+    values = _finite(np.asarray(x, dtype=float))
+    if (values < 0).any():
+        raise ValueError("Cannot take square root of a negative number.")
+    return np.sqrt(values).tolist()
+
+
+# ----------------------------
+# FAST DISPATCH TABLE
+# ----------------------------
+# Validators per argument type, built once
+# (same lax coercion rules FastMCP applies, e.g. "5" → 5)
+_INT = TypeAdapter(int).validate_python
+_FLOAT = TypeAdapter(float).validate_python
+_FLOATS = TypeAdapter(list[float]).validate_python
+
+_FAST_TOOLS = {
+    "add": (add, {"a": _INT, "b": _INT}),
+    "multiply": (multiply, {"a": _INT, "b": _INT}),
+    "divide": (divide, {"a": _FLOAT, "b": _FLOAT}),
+    "square_root": (square_root, {"x": _FLOAT}),
+    "factorial": (factorial, {"n": _INT}),
+    "add_batch": (add_batch, {"a": _FLOATS, "b": _FLOATS}),
+    "multiply_batch": (multiply_batch, {"a": _FLOATS, "b": _FLOATS}),
+    "divide_batch": (divide_batch, {"a": _FLOATS, "b": _FLOATS}),
+    "sqrt_batch": (sqrt_batch, {"x": _FLOATS}),
+}
+
+
+# ----------------------------
+# HTTP APP
+# ----------------------------
+# Module-level so each uvicorn worker can import it as "mcp_server:app"
+app = mcp.streamable_http_app()
+
+
 # ----------------------------
 # SERVER ENTRY POINT
 # ----------------------------
 if __name__ == "__main__":
     """
-    Starts the MCP server using HTTP transport.
-    This allows LangChain / LangGraph clients to call tools over HTTP.
-    
+    Starts the MCP server.
+
+    python mcp_server.py --stdio
+    Serves over stdin/stdout. This is how mcp_client.py
+    launches it, as a child process on the same machine.
+
+    python mcp_server.py
+    Serves over HTTP, for clients on other processes/machines.
     URL exposed:
     http://127.0.0.1:8000/mcp
     """
-    mcp.run(transport="streamable-http")  # this is also local server but still acts as remote
-
-    # mcp.run(transport="stdio") if local server
+    if "--stdio" in sys.argv:
+        mcp.run(transport="stdio")
+    else:
+        # Same as mcp.run(transport="streamable-http"), but started explicitly
+        # so the runtime can be chosen: "auto" picks uvloop (libuv event loop)
+        # and httptools (C HTTP parser) when installed, and falls back to
+        # asyncio / h11 where they are not available (e.g. uvloop on Windows)
+        uvicorn.run(
+            "mcp_server:app",
+            app_dir=os.path.dirname(os.path.abspath(__file__)),
+            workers=HTTP_WORKERS,
+            host=mcp.settings.host,
+            port=mcp.settings.port,
+            loop="auto",
+            http="auto",
+            backlog=HTTP_BACKLOG,
+            timeout_keep_alive=HTTP_KEEP_ALIVE_SECONDS,
+        )  # this is also local server but still acts as remote